@@ -1,17 +1,29 @@
 from typing import List, Optional
 import geopandas as gpd
 import shapely
-import pandas as pd
+import numpy as np
 import s2sphere as s2
 import streamlit as st
+
+# Google's C++ s2geometry bindings compute coverings far faster than the
+# pure-Python s2sphere; use them when installed, fall back otherwise
+try:
+    import pywraps2 as s2cpp
+except ImportError:
+    s2cpp = None
 import os
 import fsspec
-from shapely.wkt import loads
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from io import StringIO
-import json
+import hashlib
+import orjson
+from functools import lru_cache
 import psutil
 import gc
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
@@ -19,8 +31,21 @@ os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 BUILDING_DOWNLOAD_PATH = 'gs://open-buildings-data/v3/polygons_s2_level_6_gzip_no_header'
 BUILDING_DOWNLOAD_URL = 'https://storage.googleapis.com/open-buildings-data/v3/polygons_s2_level_6_gzip_no_header'
 
+# Shared session so concurrent tile downloads reuse TCP/TLS connections
+# instead of paying a handshake per request
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# Tiles confirmed on disk this process lifetime; lets reruns skip the stat call
+_DOWNLOADED = set()
+
+@lru_cache(maxsize=256)
 def wkt_to_s2(your_own_wkt_polygon: str) -> List[str]:
-    """Takes a WKT polygon, converts to a geopandas GeoDataFrame, and returns S2 covering tokens."""
+    """Takes a WKT polygon, converts to a geopandas GeoDataFrame, and returns S2 covering tokens.
+
+    The covering is deterministic in the WKT string, so results are memoized
+    across Streamlit reruns (map pans re-trigger the script with the same polygon).
+    """
 
     # Convert WKT polygon to GeoDataFrame
     region_df = gpd.GeoDataFrame(
@@ -34,20 +59,35 @@ def wkt_to_s2(your_own_wkt_polygon: str) -> List[str]:
     
     # Get bounds of the region
     region_bounds = region_df.iloc[0].geometry.bounds
-    
+
+    if s2cpp is not None:
+        # C++ covering path (same algorithm, compiled)
+        sw_latlng = s2cpp.S2LatLng.FromDegrees(region_bounds[1], region_bounds[0])  # sw corner
+        ne_latlng = s2cpp.S2LatLng.FromDegrees(region_bounds[3], region_bounds[2])  # ne corner
+
+        region_coverer = s2cpp.S2RegionCoverer()
+        region_coverer.set_min_level(6)
+        region_coverer.set_max_level(6)
+        region_coverer.set_max_cells(1000000)
+
+        rect = s2cpp.S2LatLngRect.FromPointPair(sw_latlng, ne_latlng)
+        tokens = [cell.ToToken() for cell in region_coverer.GetCovering(rect)]
+        print(tokens)
+        return tokens
+
     # Create S2LatLngRect for covering using s2sphere
     sw_latlng = s2.LatLng.from_degrees(region_bounds[1], region_bounds[0])  # sw corner
     ne_latlng = s2.LatLng.from_degrees(region_bounds[3], region_bounds[2])  # ne corner
-    
+
     # Create covering using s2sphere
     region_coverer = s2.RegionCoverer()
     region_coverer.max_level = 6
     region_coverer.min_level = 6
     region_coverer.max_cells = 1000000
-    
+
     # Create a rect region
     rect = s2.LatLngRect.from_point_pair(sw_latlng, ne_latlng)
-    
+
     # Get covering
     covering = region_coverer.get_covering(rect)
     tokens = [cell.to_token() for cell in covering]
@@ -62,17 +102,20 @@ from streamlit.runtime.uploaded_file_manager import UploadedFile
 from typing import Optional
 from st_files_connection import FilesConnection
 
-def download_data_from_s2_code(s2_code: str, data_dir: str) -> Optional[str]:
+def download_data_from_s2_code(s2_code: str, data_dir: str, show_progress: bool = True) -> Optional[str]:
     """
     Downloads data from Google Cloud Storage based on S2 code for building polygons.
     Args:
         s2_code (str): S2 code to download building polygons for.
         data_dir (str): Directory to save the downloaded data.
+        show_progress (bool): Whether to render Streamlit progress widgets.
+            Must be False when called from a worker thread.
     Returns:
         Optional[str]: Path to gzipped CSV file if successful, None otherwise.
     """
     if not isinstance(s2_code, str) or not isinstance(data_dir, str):
-        st.error("Both s2_code and data_dir must be strings")
+        if show_progress:
+            st.error("Both s2_code and data_dir must be strings")
         return None
     
     print(s2_code)
@@ -85,9 +128,12 @@ def download_data_from_s2_code(s2_code: str, data_dir: str) -> Optional[str]:
     
     # st.sidebar.write(f"Downloading data to: {output_path}")
     
-    # Check if the file already exists
+    # Check if the file already exists (in-process set first, then disk)
+    if output_path in _DOWNLOADED:
+        return output_path
     if os.path.exists(output_path):
         print(f"File already exists: {output_path}")
+        _DOWNLOADED.add(output_path)
         return output_path
 
     try:
@@ -96,11 +142,12 @@ def download_data_from_s2_code(s2_code: str, data_dir: str) -> Optional[str]:
         print(download_url)
 
         # Initialize progress bar
-        status_text = st.sidebar.empty()
-        progress_bar = st.sidebar.progress(0)
+        if show_progress:
+            status_text = st.sidebar.empty()
+            progress_bar = st.sidebar.progress(0)
 
-        # Download with streaming
-        response = requests.get(download_url, stream=True)
+        # Download with streaming over the shared keep-alive session
+        response = _SESSION.get(download_url, stream=True)
         response.raise_for_status()
 
         # Get total file size
@@ -109,116 +156,243 @@ def download_data_from_s2_code(s2_code: str, data_dir: str) -> Optional[str]:
         # Download the file in chunks
         with open(output_path, 'wb') as out:
             bytes_downloaded = 0
-            chunk_size = 65536  # 64KB chunks
+            chunk_size = 1048576  # 1MB chunks: fewer loop iterations, better disk throughput
+            chunks_written = 0
 
             for chunk in response.iter_content(chunk_size=chunk_size):
                 if chunk:
                     out.write(chunk)
                     bytes_downloaded += len(chunk)
+                    chunks_written += 1
 
-                    if total_size > 0:
-                        progress = min(1.0, bytes_downloaded / total_size)
-                        progress_bar.progress(progress)
-                        status_text.write(f"Downloaded {bytes_downloaded/1e6:.2f} MB out of {total_size/1e6:.2f} MB")
-                    else:
-                        status_text.write(f"Downloaded {bytes_downloaded/1e6:.2f} MB")
+                    # Throttle widget updates; every rerender costs far more
+                    # than the download work itself
+                    if show_progress and chunks_written % 4 == 0:
+                        if total_size > 0:
+                            progress = min(1.0, bytes_downloaded / total_size)
+                            progress_bar.progress(progress)
+                            status_text.write(f"Downloaded {bytes_downloaded/1e6:.2f} MB out of {total_size/1e6:.2f} MB")
+                        else:
+                            status_text.write(f"Downloaded {bytes_downloaded/1e6:.2f} MB")
 
         # Clear status elements
-        status_text.empty()
-        progress_bar.empty()
+        if show_progress:
+            status_text.empty()
+            progress_bar.empty()
 
         # Verify the downloaded file exists and is not empty
         if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-            st.success(f"Download completed: {output_path}")
+            if show_progress:
+                st.success(f"Download completed: {output_path}")
+            _DOWNLOADED.add(output_path)
             return str(output_path)
         else:
-            st.error("Downloaded file is empty or does not exist")
+            if show_progress:
+                st.error("Downloaded file is empty or does not exist")
             return None
-            
+
     except Exception as e:
-        st.error(f"Error during download: {str(e)}")
+        if show_progress:
+            st.error(f"Error during download: {str(e)}")
+        print(f"Error downloading {s2_code}: {e}")
         # Clean up any partial file if it exists
         if os.path.exists(output_path):
             try:
                 os.remove(output_path)
-                st.write(f"Partial file removed: {output_path}")
+                print(f"Partial file removed: {output_path}")
             except Exception as cleanup_error:
-                st.error(f"Error cleaning up partial file: {str(cleanup_error)}")
+                print(f"Error cleaning up partial file: {cleanup_error}")
         return None
 
-def load_and_filter_gob_data_streaming(gob_filepath, input_geometry):
+def download_data_from_s2_codes(s2_codes: List[str], data_dir: str, max_workers: int = 8) -> List[Optional[str]]:
+    """
+    Downloads building data for several S2 codes concurrently.
+
+    The GCS requests are latency-bound, so running them through a thread
+    pool hides the round-trip time. Progress is reported once per completed
+    tile to keep Streamlit reruns cheap.
+    Args:
+        s2_codes (List[str]): S2 codes to download building polygons for.
+        data_dir (str): Directory to save the downloaded data.
+        max_workers (int): Number of concurrent downloads.
+    Returns:
+        List[Optional[str]]: Paths to gzipped CSV files, in s2_codes order.
+    """
+    status_text = st.sidebar.empty()
+    progress_bar = st.sidebar.progress(0)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_data_from_s2_code, s2_code, data_dir, show_progress=False): s2_code
+            for s2_code in s2_codes
+        }
+        for completed, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]] = future.result()
+            progress_bar.progress(completed / len(futures))
+            status_text.write(f"Downloaded {completed} of {len(futures)} S2 tiles")
+
+    status_text.empty()
+    progress_bar.empty()
+
+    return [results[s2_code] for s2_code in s2_codes]
+
+def load_and_filter_gob_data_streaming(gob_filepath, input_geometry, simplify_tolerance=1e-5):
     """
     Memory-efficient streaming processing of GOB data with chunked reading.
+
+    Building polygons are simplified with `simplify_tolerance` (in degrees)
+    before serialization to shrink the GeoJSON payload sent to the browser.
+    Set it to 0 to keep the original vertices.
     """
     try:
         header = ['latitude', 'longitude', 'area_in_meters', 'confidence', 'geometry', 'full_plus_code']
-        
+
         # Initialize counters and accumulators
         building_count = 0
         confidence_sum = 0
-        filtered_features = []
-        
-        # Process CSV in chunks to reduce memory usage
-        chunk_size = 10000  # Process 10k records at a time
-        
-        for chunk in pd.read_csv(gob_filepath, chunksize=chunk_size):
-            chunk.columns = header
-            
-            # Convert geometry strings to shapely objects for this chunk only
-            chunk['geometry'] = chunk['geometry'].apply(loads)
-            chunk_gdf = gpd.GeoDataFrame(chunk, crs='EPSG:4326')
-            
-            # Filter intersecting geometries
-            filtered_chunk = chunk_gdf[chunk_gdf.intersects(input_geometry)]
-            
-            if not filtered_chunk.empty:
-                # Update counters
-                building_count += len(filtered_chunk)
-                confidence_sum += filtered_chunk['confidence'].sum()
-                
-                # Convert to GeoJSON features and append
-                for _, row in filtered_chunk.iterrows():
-                    feature = {
-                        "type": "Feature",
-                        "geometry": row['geometry'].__geo_interface__,
-                        "properties": {
-                            "latitude": row['latitude'],
-                            "longitude": row['longitude'],
-                            "area_in_meters": row['area_in_meters'],
-                            "confidence": row['confidence'],
-                            "full_plus_code": row['full_plus_code']
-                        }
-                    }
-                    filtered_features.append(feature)
-            
-            # Clear chunk from memory
-            del chunk_gdf, filtered_chunk
-            gc.collect()  # Force garbage collection
-        
-        # Calculate average confidence
-        avg_confidence = confidence_sum / building_count if building_count > 0 else 0
-        
-        # Create final GeoJSON structure
-        geojson_data = {
-            "type": "FeatureCollection",
-            "features": filtered_features
-        }
-        
-        # Store only essential data in session state
-        st.session_state.building_count = building_count
-        st.session_state.avg_confidence = avg_confidence
-        st.session_state.filtered_gob_data = json.dumps(geojson_data)
-        st.session_state.info_box_visible = True
-        
-        # Prepare compressed GeoJSON for download
-        st.session_state.filtered_gob_geojson = json.dumps(geojson_data, separators=(',', ':'))
-        
-        # Log memory usage
-        process = psutil.Process(os.getpid())
-        memory_mb = process.memory_info().rss / 1024 / 1024
-        print(f"Memory usage after processing: {memory_mb:.1f} MB")
+
+        # The filtered result is fully determined by the tile and the query
+        # polygon, so it is cached on disk keyed by both; a re-click on the
+        # same region skips the whole streaming pass
+        # blake2b is faster than md5 and lets us ask for exactly the digest
+        # length we want; this is a cache key, not a cryptographic check
+        cache_tag = hashlib.blake2b(input_geometry.wkt.encode(), digest_size=6).hexdigest()
+        output_path = gob_filepath.replace('.csv', f'_{cache_tag}.geojson')
+        meta_path = output_path + '.meta.json'
+
+        if os.path.exists(output_path) and os.path.exists(meta_path):
+            with open(meta_path, 'rb') as meta_file:
+                meta = orjson.loads(meta_file.read())
+            building_count = meta['building_count']
+            confidence_sum = meta['confidence_sum']
+            _finish_gob_processing(output_path, building_count, confidence_sum)
+            return
+
+        # Prepare the query polygon once so every intersects call below hits
+        # the GEOS prepared-geometry fast path, and cache its bbox for a
+        # cheap numpy prefilter
+        shapely.prepare(input_geometry)
+        query_minx, query_miny, query_maxx, query_maxy = input_geometry.bounds
+
+        # Stream the CSV as Arrow record batches; the columnar parser is faster
+        # than the pandas text reader and keeps WKT strings in Arrow buffers
+        read_options = pacsv.ReadOptions(block_size=8 << 20, column_names=header)
+        reader = pacsv.open_csv(gob_filepath, read_options=read_options)
+
+        # Matching features are streamed straight to disk so peak memory stays
+        # flat no matter how many buildings the region contains
+        out = open(output_path, 'wb')
+        out.write(b'{"type":"FeatureCollection","features":[')
+        first_chunk = True
+
+        for batch in reader:
+            # Parse all WKT strings in one vectorized C call instead of per-row
+            # .apply; malformed rows become None and fail the bbox test below
+            geometries = shapely.from_wkt(batch.column('geometry').to_numpy(zero_copy_only=False),
+                                          on_invalid='ignore')
+
+            # Vector bbox test rejects most buildings before any exact
+            # intersection; survivors go through prepared intersects
+            bounds = shapely.bounds(geometries)
+            candidate_idx = np.nonzero(
+                (bounds[:, 0] <= query_maxx) & (bounds[:, 2] >= query_minx) &
+                (bounds[:, 1] <= query_maxy) & (bounds[:, 3] >= query_miny)
+            )[0]
+            hit_idx = candidate_idx[shapely.intersects(geometries[candidate_idx], input_geometry)]
+
+            if len(hit_idx) > 0:
+                # Only the surviving rows are wrapped in a GeoDataFrame; the
+                # rejected majority never leaves Arrow/numpy
+                hit_geometries = geometries[hit_idx]
+
+                # Drop redundant vertices before serialization; fewer coordinates
+                # means smaller GeoJSON and faster browser rendering
+                if simplify_tolerance:
+                    hit_geometries = shapely.simplify(hit_geometries, simplify_tolerance,
+                                                      preserve_topology=False)
+
+                # Snap coordinates to a 1e-6 degree grid (~10 cm); full float64
+                # precision only bloats the serialized payload
+                hit_geometries = shapely.set_precision(hit_geometries, 1e-6)
+
+                hit_batch = batch.drop_columns(['geometry']).take(hit_idx)
+
+                # Update counters straight from the Arrow columns; no pandas
+                # index or Series machinery on the stats path
+                building_count += len(hit_idx)
+                confidence_sum += pc.sum(hit_batch.column('confidence')).as_py()
+
+                filtered_chunk = gpd.GeoDataFrame(hit_batch.to_pandas(),
+                                                  geometry=hit_geometries, crs='EPSG:4326')
+
+                # Serialize the whole chunk in one GeoPandas C-level pass instead
+                # of iterrows, then append the raw feature array to the file
+                chunk_features = orjson.loads(filtered_chunk.to_json(drop_id=True))['features']
+                payload = orjson.dumps(chunk_features)[1:-1]  # strip the list brackets
+                if payload:
+                    if not first_chunk:
+                        out.write(b',')
+                    out.write(payload)
+                    first_chunk = False
+                del filtered_chunk
+
+            # Clear chunk from memory; refcounting frees the big arrays here,
+            # a full gc.collect() per chunk just burns CPU walking the heap
+            del geometries
         
-        st.rerun()
+        out.write(b']}')
+        out.close()
+
+        # Persist the stats next to the features so later runs can reuse both
+        with open(meta_path, 'wb') as meta_file:
+            meta_file.write(orjson.dumps(
+                {'building_count': building_count, 'confidence_sum': confidence_sum}))
+
+        _finish_gob_processing(output_path, building_count, confidence_sum)
     except Exception as e:
         st.error(f"Error processing GOB data: {str(e)}")
-        print(e)
\ No newline at end of file
+        print(e)
+
+def _finish_gob_processing(output_path, building_count, confidence_sum):
+    """Publishes a filtered GeoJSON file (fresh or cached) to session state."""
+    # Calculate average confidence
+    avg_confidence = confidence_sum / building_count if building_count > 0 else 0
+
+    # The map overlay still needs the payload in memory once to build the
+    # geometry list, but it is read back from disk rather than built
+    # feature-by-feature in a Python list; orjson parses bytes natively.
+    with open(output_path, 'rb') as geojson_file:
+        parsed_geojson = orjson.loads(geojson_file.read())
+
+    # Store only essential data in session state. The map layer gets the
+    # parsed dict so folium does not re-parse a multi-MB string on every
+    # rerun; the download button reads from the on-disk file on demand.
+    # The overlay never displays properties, so embed geometry only —
+    # roughly halves the JSON inlined into the map iframe.
+    st.session_state.building_count = building_count
+    st.session_state.avg_confidence = avg_confidence
+    st.session_state.filtered_gob_data = {
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature", "geometry": feature["geometry"]}
+                     for feature in parsed_geojson["features"]]
+    }
+    # The GOB CSV carries each building's centroid; keep it so the map can
+    # fall back to clustered markers when the polygon count gets large
+    st.session_state.filtered_gob_centroids = [
+        (feature["properties"]["latitude"], feature["properties"]["longitude"])
+        for feature in parsed_geojson["features"]]
+    # The download button serves the on-disk file lazily; no need to pin a
+    # second copy of the full payload in session state
+    st.session_state.filtered_gob_path = output_path
+    st.session_state.info_box_visible = True
+
+    # One collection after the loop is enough to return freed pages
+    gc.collect()
+
+    # Log memory usage
+    process = psutil.Process(os.getpid())
+    memory_mb = process.memory_info().rss / 1024 / 1024
+    print(f"Memory usage after processing: {memory_mb:.1f} MB")
+
+    st.rerun()
\ No newline at end of file
@@ -2,20 +2,66 @@ import os
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
-from folium.plugins import Fullscreen
-import geojson
-from shapely.geometry import shape
+from folium.plugins import Fullscreen, MarkerCluster
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
 from pyproj import Transformer
-from io import BytesIO
-import json
-from google_openbuildings import *
-from map_features import *
-from file_manager import *
+
+# Geobuf output is ~6-8x smaller than minified GeoJSON; offered when the
+# encoder is installed
+try:
+    import geobuf
+except ImportError:
+    geobuf = None
+from map_features import get_imagery_dates
+from file_manager import uncompress
+
+# google_openbuildings pulls in geopandas/pyarrow/shapely; it is imported
+# lazily inside the functions that need it so cold start and plain reruns
+# don't pay for it (the import is a dict lookup once the module is loaded)
 
 data_dir = './data/'
 APP_TITLE = "Open Buildings Explorer"
 st.set_page_config(page_title=APP_TITLE, layout="wide")
 
+@st.cache_data(max_entries=4)
+def parse_uploaded_geojson(data: bytes):
+    # One parse per uploaded file; reruns hash the bytes and hit the cache
+    return orjson.loads(data)
+
+@st.cache_data(max_entries=4)
+def feature_name_index(data: bytes):
+    # name -> position built once per upload; selection becomes an O(1)
+    # dict lookup instead of a linear scan per rerun
+    features = parse_uploaded_geojson(data)['features']
+    return {feature['properties'].get('name', f'Feature {i}'): i
+            for i, feature in enumerate(features)}
+
+@st.cache_data(max_entries=4)
+def feature_geometries(data: bytes):
+    # Shapely construction and centroids once per upload; shapely geometries
+    # pickle fine, so the cache can hand them back on rerun
+    import geopandas as gpd
+
+    features = parse_uploaded_geojson(data)['features']
+    geometries = gpd.GeoDataFrame.from_features(features).geometry
+    centroids = geometries.centroid
+    return list(geometries), [(point.y, point.x) for point in centroids]
+
+@st.cache_data(ttl=3600, max_entries=256)
+def cached_imagery_dates(bbox, zoom_level):
+    # The ESRI metadata answer only depends on the mercator bbox and zoom;
+    # the dates come back as an unordered frozenset, so sort for display
+    return sorted(get_imagery_dates(bbox, zoom_level))
+
+@lru_cache(maxsize=1)
+def _wgs84_to_mercator():
+    # Transformer construction parses PROJ definitions; build it once per
+    # process instead of on every rerun
+    return Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
 def setup_app():
     # st.title(APP_TITLE)
     st.sidebar.title("Open Buildings Explorer")
@@ -36,13 +82,18 @@ def initialize_session_state():
         'bounds': None,
         'zoom': 0,
         's2_tokens': [],
+        'filtered_gob_path': None,
+        'filtered_gob_pbf': None,
+        'filtered_gob_centroids': None,
+        'show_all_buildings': False,
     }.items():
         if key not in st.session_state:
             st.session_state[key] = default
 
 def process_uploaded_file(uploaded_file):
     try:
-        geojson_data = geojson.load(uploaded_file)
+        raw = uploaded_file.getvalue()
+        geojson_data = parse_uploaded_geojson(raw)
         features = geojson_data['features']
         feature_names = [feature['properties'].get('name', f'Feature {i}') for i, feature in enumerate(features)]
         selected_feature_name = st.sidebar.selectbox("Select a feature to display", feature_names)
@@ -52,51 +103,104 @@ def process_uploaded_file(uploaded_file):
             st.session_state.building_count = 0
             st.session_state.avg_confidence = 0.0
             st.session_state.info_box_visible = False
+            st.session_state.filtered_gob_centroids = None
+            st.session_state.filtered_gob_path = None
+            st.session_state.filtered_gob_pbf = None
+            st.session_state.show_all_buildings = False
 
         st.session_state.selected_feature_name = selected_feature_name
-        selected_feature = next((feature for feature in features if feature['properties'].get('name') == selected_feature_name), None)
+        selected_index = feature_name_index(raw).get(selected_feature_name)
 
-        if selected_feature:
-            display_selected_feature(selected_feature)
+        if selected_index is not None:
+            # Geometries and centroids come from the per-upload cache, so a
+            # rerun from a map pan costs a cache lookup instead of a reparse
+            geometries, centers = feature_geometries(raw)
+            display_selected_feature(features[selected_index],
+                                     geometries[selected_index],
+                                     centers[selected_index])
 
     except Exception as e:
         st.sidebar.error(f"Error processing GeoJSON file: {str(e)}")
         st.sidebar.error("Please make sure your GeoJSON file is properly formatted.")
 
-def display_selected_feature(selected_feature):
-    input_geometry = shape(selected_feature['geometry'])
+MAX_INLINE_BUILDINGS = 5000
+
+@st.cache_resource(max_entries=8)
+def build_rendered_map(cache_key, _selected_feature, center_lat, center_lon, _gob_data, _gob_centroids,
+                       show_all_buildings=False):
+    """Compose the map and pay the Jinja render once per distinct content.
+
+    `cache_key` carries the identity of the unhashable payloads
+    (`_selected_feature`, `_gob_data`); st_folium is then called with
+    render=False so the template render is skipped on plain reruns.
+    """
+    # Deepcopy the cached base map so the overlays below never mutate the
+    # shared cached instance
+    m = copy.deepcopy(create_base_map(round(center_lat, 4), round(center_lon, 4)))
+    folium.GeoJson(_selected_feature).add_to(m)
+    Fullscreen(position="topright", title="Expand me", title_cancel="Exit me", force_separate_button=True).add_to(m)
+
+    if _gob_data is not None:
+        if (_gob_centroids and len(_gob_centroids) > MAX_INLINE_BUILDINGS
+                and not show_all_buildings):
+            # Leaflet chokes on tens of thousands of inline polygons; show
+            # clustered centroid markers instead at this scale
+            MarkerCluster(locations=_gob_centroids, name='Buildings').add_to(m)
+        else:
+            folium.GeoJson(_gob_data).add_to(m)
+
+    m.get_root().render()
+    return m
+
+def display_selected_feature(selected_feature, input_geometry, center):
+    from google_openbuildings import wkt_to_s2
+
     wkt_representation = input_geometry.wkt
     s2_tokens = wkt_to_s2(wkt_representation)
 
-    center_lat, center_lon = get_geometry_center(input_geometry)
+    center_lat, center_lon = center
     st.session_state.lat = center_lat
     st.session_state.lon = center_lon
-    
-    m = create_base_map(center_lat, center_lon)
-    folium.GeoJson(selected_feature).add_to(m)
-    Fullscreen(position="topright", title="Expand me", title_cancel="Exit me", force_separate_button=True).add_to(m)
 
-    if st.session_state.filtered_gob_data is not None:
-        folium.GeoJson(st.session_state.filtered_gob_data).add_to(m)
+    gob_data = st.session_state.filtered_gob_data
+    cache_key = (st.session_state.selected_feature_name,
+                 round(center_lat, 4), round(center_lon, 4),
+                 st.session_state.building_count, gob_data is not None,
+                 st.session_state.show_all_buildings)
+    m = build_rendered_map(cache_key, selected_feature, center_lat, center_lon, gob_data,
+                           st.session_state.get('filtered_gob_centroids'),
+                           show_all_buildings=st.session_state.show_all_buildings)
 
-    st.session_state.map_data = st_folium(m, width=1200, height=800)#, returned_objects=[])
+    # Only bounds and zoom are consumed downstream; restricting the returned
+    # objects stops clicks/hovers from triggering full script reruns. The key
+    # tracks the map content, so reruns with unchanged content keep the
+    # component mounted and skip re-uploading the overlay payload
+    st.session_state.map_data = st_folium(m, width=1200, height=800, render=False,
+                                          key=f"map_{cache_key}", returned_objects=["bounds", "zoom"])
     # print(st.session_state.map_data)
 
+    if (st.session_state.get('filtered_gob_centroids')
+            and len(st.session_state.filtered_gob_centroids) > MAX_INLINE_BUILDINGS
+            and not st.session_state.show_all_buildings):
+        # The fast clustered view is the default past the threshold; loading
+        # every polygon is opt-in since it can take a while to render
+        if st.sidebar.button("Show all building polygons"):
+            st.session_state.show_all_buildings = True
+            st.rerun()
+
     st.session_state.s2_tokens = s2_tokens
     st.session_state.input_geometry = input_geometry
 
     # Update info box visibility whenever we display a feature
     # st.session_state.info_box_visible = True
 
-def get_geometry_center(geometry):
-    if geometry.geom_type == 'Point':
-        return geometry.y, geometry.x
-    else:
-        centroid = geometry.centroid
-        return centroid.y, centroid.x
-
+@st.cache_resource(max_entries=32)
 def create_base_map(lat, lon):
-    m = folium.Map(location=[lat, lon], zoom_start=12)
+    # lat/lon arrive quantized (see display_selected_feature) so pan jitter
+    # still hits the cache. Callers must deepcopy before adding overlays.
+    # prefer_canvas makes Leaflet draw vectors on a canvas instead of one
+    # SVG node per polygon, which matters once the building overlay is big
+    m = folium.Map(location=[lat, lon], zoom_start=12, prefer_canvas=True)
     folium.TileLayer(
         name='ArcGIS World Imagery',
         control=True,
@@ -106,19 +210,25 @@ def create_base_map(lat, lon):
     return m
 
 def download_and_process_gob_data(s2_tokens, input_geometry):
-    user_warning = st.sidebar.empty()  
+    from google_openbuildings import download_data_from_s2_codes, load_and_filter_gob_data_streaming
 
-    for s2_token in s2_tokens:
-        st.session_state.progress_message = f"Downloading GOB data for S2 token: {s2_token}. Please wait..."
-        user_warning.info(st.session_state.progress_message)
+    user_warning = st.sidebar.empty()
 
-        try:
-            gob_data_compressed = download_data_from_s2_code(s2_token, data_dir)
-            gob_filepath = uncompress(gob_data_compressed, delete_compressed=False)
-        except Exception as e:
-            st.error(f"Detailed error: {str(e)}")
-            print(e)
-            raise
+    st.session_state.progress_message = f"Downloading GOB data for {len(s2_tokens)} S2 tokens. Please wait..."
+    user_warning.info(st.session_state.progress_message)
+
+    try:
+        compressed_paths = download_data_from_s2_codes(s2_tokens, data_dir)
+        # Decompress the tiles concurrently too; gzip releases the GIL while
+        # inflating, so the pool overlaps CPU and disk work across tiles
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            gob_filepaths = list(executor.map(
+                lambda path: uncompress(path, delete_compressed=False), compressed_paths))
+        gob_filepath = gob_filepaths[-1]
+    except Exception as e:
+        st.error(f"Detailed error: {str(e)}")
+        print(e)
+        raise
 
     user_warning.info("Filtering GOB data...")
     load_and_filter_gob_data_streaming(gob_filepath, input_geometry)
@@ -131,52 +241,79 @@ def display_fixed_info_box():
         st.metric(label="Total of buildings (% confidence level)", 
                  value=f"{st.session_state.building_count} ({st.session_state.avg_confidence:.2f})")
         
-        if hasattr(st.session_state, 'filtered_gob_geojson') and st.session_state.filtered_gob_geojson:
-            geojson_bytes = BytesIO(st.session_state.filtered_gob_geojson.encode("utf-8"))
+        gob_path = st.session_state.filtered_gob_path
+        if gob_path and os.path.exists(gob_path):
+            # A deferred callable means the file is only read when the user
+            # actually clicks Download; reruns pay nothing
             st.download_button(
                 label="Download GeoJSON",
-                data=geojson_bytes,
+                data=lambda: open(gob_path, 'rb').read(),
                 file_name="filtered_gob_data.geojson",
                 mime="application/geo+json"
             )
 
+            if geobuf is not None:
+                # Encode lazily; most users never ask for the compact format
+                if st.button("Prepare Geobuf"):
+                    with open(gob_path, 'rb') as geojson_file:
+                        st.session_state.filtered_gob_pbf = geobuf.encode(
+                            orjson.loads(geojson_file.read()), 6)
+                if st.session_state.get('filtered_gob_pbf'):
+                    st.download_button(
+                        label="Download Geobuf",
+                        data=st.session_state.filtered_gob_pbf,
+                        file_name="filtered_gob_data.pbf",
+                        mime="application/x-protobuf"
+                    )
+
 
     # Display imagery dates if zoom level is sufficient
 
 
+@st.fragment
+def display_map_fragment(uploaded_file):
+    # Map pans/zooms rerun only this fragment: feature selection, the map
+    # itself and the imagery dates. The fetch button and info box outside
+    # are untouched by pure map interaction.
+    process_uploaded_file(uploaded_file)
+    # get imagery dates
+    if st.session_state.map_data is not None:
+        bounds = st.session_state.map_data.get('bounds')
+        zoom_level = st.session_state.map_data.get('zoom', 0)
+    else:
+        bounds = None
+        zoom_level = 0
+
+    if zoom_level >= 12 and bounds:
+        transformer = _wgs84_to_mercator()
+        # One batched PROJ call for both corners instead of two scalar ones
+        (sw_x, ne_x), (sw_y, ne_y) = transformer.transform(
+            [bounds['_southWest']['lng'], bounds['_northEast']['lng']],
+            [bounds['_southWest']['lat'], bounds['_northEast']['lat']])
+        # print(sw_x, sw_y, ne_x, ne_y)
+
+        # Snap the bbox to a 1 m grid so nearby pans reuse the cached answer
+        dates = cached_imagery_dates(
+            (round(sw_x), round(sw_y), round(ne_x), round(ne_y)), int(zoom_level))
+        if dates:
+            # change to str
+            dates = ", ".join(dates)
+            print(dates)
+            st.session_state.imagery_dates = dates
+            # write
+            st.sidebar.write(f"Imagery dates: {dates}")
+    else:
+        st.session_state.imagery_dates = f"Curent zoom level: {zoom_level} - Imagery dates are only available at zoom level 12 or higher."
+        # write
+    #st.sidebar.write(st.session_state.imagery_dates)
+
 def main():
     setup_app()
     uploaded_file = st.sidebar.file_uploader("Upload a GeoJSON file", type="geojson")
     initialize_session_state()
 
     if uploaded_file:
-        process_uploaded_file(uploaded_file)
-        # get imagery dates
-        if st.session_state.map_data is not None:
-            bounds = st.session_state.map_data.get('bounds')
-            zoom_level = st.session_state.map_data.get('zoom', 0)
-        else:
-            bounds = None
-            zoom_level = 0
-
-        if zoom_level >= 12 and bounds:
-            transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-            sw_x, sw_y = transformer.transform(bounds['_southWest']['lng'], bounds['_southWest']['lat'])
-            ne_x, ne_y = transformer.transform(bounds['_northEast']['lng'], bounds['_northEast']['lat'])
-            # print(sw_x, sw_y, ne_x, ne_y)
-
-            dates = get_imagery_dates((sw_x, sw_y, ne_x, ne_y), zoom_level)
-            if dates:
-                # change to str
-                dates = ", ".join(dates)
-                print(dates)
-                st.session_state.imagery_dates = dates
-                # write
-                st.sidebar.write(f"Imagery dates: {dates}")
-        else:
-            st.session_state.imagery_dates = f"Curent zoom level: {zoom_level} - Imagery dates are only available at zoom level 12 or higher."
-            # write
-        #st.sidebar.write(st.session_state.imagery_dates)
+        display_map_fragment(uploaded_file)
 
         if st.sidebar.button("Fetch GOB Data", key="download_gob_button"):
             download_and_process_gob_data(st.session_state.s2_tokens, st.session_state.input_geometry)
@@ -1,77 +1,62 @@
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
 import streamlit as st
 
+# Module-level session so repeated metadata queries reuse the TCP+TLS
+# connection to arcgisonline instead of handshaking every call
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 def get_imagery_dates(bounds, zoom_level):
     """
     Query ESRI World Imagery service for image dates within the given bounds.
     """
     if zoom_level < 12:
         st.sidebar.info("Please zoom in to level 12 or higher to see imagery dates.")
-        return {}
+        return frozenset()
         
     base_url = "https://services.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/0/query"
     
     params = {
         'f': 'json',
         'spatialRel': 'esriSpatialRelIntersects',
-        'geometry': json.dumps({
+        'geometry': orjson.dumps({
             'xmin': bounds[0],
             'ymin': bounds[1],
             'xmax': bounds[2],
             'ymax': bounds[3],
             'spatialReference': {'wkid': 102100}
-        }),
+        }).decode(),
         'geometryType': 'esriGeometryEnvelope',
         'inSR': 102100,
         'outSR': 3857,
-        'outFields': '*',
-        'returnGeometry': True
+        # Only the capture date is consumed; skipping the footprint
+        # geometries and extra attributes shrinks the response by an order
+        # of magnitude
+        'outFields': 'SRC_DATE',
+        'returnGeometry': False
     }
     
     try:
-        response = requests.get(base_url, params=params)
+        response = _SESSION.get(base_url, params=params, timeout=10)
         response.raise_for_status()
-        data = response.json()
+        # orjson parses the raw bytes directly; noticeably faster than
+        # response.json() on large ESRI payloads
+        data = orjson.loads(response.content)
         
         if 'features' not in data:
             st.sidebar.error("No imagery data received from the server.")
-            return {}
-            
-        dates_dict = {}
+            return frozenset()
+
+        dates = set()
         for feature in data['features']:
             if 'attributes' in feature and 'SRC_DATE' in feature['attributes']:
                 date_str = str(feature['attributes']['SRC_DATE'])
-                formatted_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-                geojson_feature = convert_esri_feature_to_geojson(feature)
-                if geojson_feature:
-                    dates_dict[formatted_date] = geojson_feature
-        # print(dates_dict.keys())
-        return dates_dict.keys()
-        
+                dates.add(f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}")
+        return frozenset(dates)
+
     except requests.exceptions.RequestException as e:
         st.sidebar.error(f"Error fetching imagery dates: {str(e)}")
-        return {}
-    
-def convert_esri_feature_to_geojson(esri_feature):
-    """
-    Convert ESRI Feature to GeoJSON format
-    """
-    try:
-        geojson_feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": []
-            },
-            "properties": esri_feature.get('attributes', {})
-        }
-        
-        if 'geometry' in esri_feature and 'rings' in esri_feature['geometry']:
-            geojson_feature['geometry']['coordinates'] = esri_feature['geometry']['rings']
-            
-        return geojson_feature
-    except Exception as e:
-        st.error(f"Error converting ESRI feature to GeoJSON: {str(e)}")
-        return None
+        return frozenset()